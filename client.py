@@ -27,7 +27,7 @@ from sklearn.model_selection import train_test_split
 # Define Flower client )
 class FlowerClient(fl.client.NumPyClient):
     def __init__(self, model, train_loader, val_loader, optimizer, num_examples, 
-                 client_id, train_fn, evaluate_fn, device):
+                 client_id, train_fn, evaluate_fn, device, scaler=None):
         self.model = model
         self.train_loader = train_loader
         self.val_loader = val_loader
@@ -37,6 +37,7 @@ class FlowerClient(fl.client.NumPyClient):
         self.train_fn = train_fn
         self.evaluate_fn = evaluate_fn
         self.device = device
+        self.scaler = scaler
 
     def get_parameters(self, config):
         return [val.cpu().numpy() for _, val in self.model.state_dict().items()]
@@ -50,7 +51,7 @@ class FlowerClient(fl.client.NumPyClient):
         try: 
             self.set_parameters(parameters)
             for epoch in range(config["local_epochs"]):
-                self.train_fn(self.model, self.device, self.train_loader, self.optimizer, epoch, self.client_id)
+                self.train_fn(self.model, self.device, self.train_loader, self.optimizer, epoch, self.client_id, scaler=self.scaler)
         except Exception as e:
             print(f"An error occurred during training of Honest client {self.client_id}: {e}, returning model with error") 
         
@@ -116,11 +117,13 @@ def main()->None:
     val_loader = DataLoader(val_dataset, batch_size=cfg.test_batch_size, shuffle=False)
 
     # Optimizer and Loss function
-    optimizer = torch.optim.SGD(model.parameters(), lr=cfg.lr, momentum=cfg.momentum)
+    optimizer = models.ForeachSGD(model.parameters(), lr=cfg.lr, momentum=cfg.momentum)
+    # one loss scaler for the whole run, so its scale is kept across local epochs and rounds
+    scaler = torch.amp.GradScaler('cuda', enabled=device == 'cuda')
 
     # Start Flower client
     client = FlowerClient(model, train_loader, val_loader, optimizer, num_examples, args.id, 
-                           models.simple_train, models.simple_test, device).to_client()
+                           models.simple_train, models.simple_test, device, scaler).to_client()
     fl.client.start_client(server_address="[::]:8098", client=client) # local host
 
     # read saved data and plot
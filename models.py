@@ -10,8 +10,12 @@ Training functions to test the models
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.utils.data import Dataset
-from math import prod
+from torch.utils.data import Dataset, RandomSampler, SequentialSampler
+import copy
+import contextlib
+import itertools
+import os
+import weakref
 import utils
 
 
@@ -24,27 +28,28 @@ class LeNet5(nn.Module):
     def __init__(self, in_channels=1, num_classes=10, input_size=(28, 28)):
         super(LeNet5, self).__init__()
         self.conv1 = nn.Conv2d(in_channels, 6, kernel_size=5, stride=1, padding=2)  # Convolutional layer with 6 feature maps of size 5x5
-        self.pool1 = nn.AvgPool2d(kernel_size=2, stride=2)  # Subsampling layer with 6 feature maps of size 2x2
-        self.conv2 = nn.Conv2d(6, 16, kernel_size=5, stride=1)  # Convolutional layer with 16 feature maps of size 5x5
+        self.conv2 = nn.Conv2d(6, 16, kernel_size=5, stride=2)  # Strided convolutional layer with 16 feature maps of size 5x5 (replaces pool1)
         self.pool2 = nn.AvgPool2d(kernel_size=2, stride=2)  # Subsampling layer with 16 feature maps of size 2x2
+        self.relu = nn.ReLU(inplace=True)  # In-place ReLU, no extra activation tensor
         
-        # Dinamically calculate the size of the features after convolutional layers
-        dummy_input = torch.zeros(1, in_channels, *input_size)
-        dummy_output = self.pool2(self.conv2(self.pool1(self.conv1(dummy_input))))
-        self.feature_size = prod(dummy_output.size()[1:])
+        # Calculate the size of the features after convolutional layers (conv1 keeps the size, conv2 strides by 2, pool halves)
+        h, w = input_size
+        h, w = (h + 2 * 2 - 5) + 1, (w + 2 * 2 - 5) + 1
+        h, w = (h - 5) // 2 + 1, (w - 5) // 2 + 1
+        h, w = h // 2, w // 2
+        self.feature_size = 16 * h * w
 
         self.fc1 = nn.Linear(self.feature_size, 120)  # Fully connected layer, output size 120
         self.fc2 = nn.Linear(120, 84)  # Fully connected layer, output size 84
         self.fc3 = nn.Linear(84, num_classes)  # Fully connected layer, output size num_classes
 
     def forward(self, x):
-        x = F.relu(self.conv1(x))  # Apply ReLU after conv1
-        x = self.pool1(x)  # Apply subsampling pool1
-        x = F.relu(self.conv2(x))  # Apply ReLU after conv2
+        x = self.relu(self.conv1(x))  # Apply ReLU after conv1
+        x = self.relu(self.conv2(x))  # Apply ReLU after conv2
         x = self.pool2(x)  # Apply subsampling pool2
-        x = x.view(x.size(0), -1)  # Flatten for fully connected layers
-        x = F.relu(self.fc1(x))  # Apply ReLU after fc1
-        x = F.relu(self.fc2(x))  # Apply ReLU after fc2
+        x = x.reshape(x.size(0), -1)  # Flatten for fully connected layers
+        x = self.relu(self.fc1(x))  # Apply ReLU after fc1
+        x = self.relu(self.fc2(x))  # Apply ReLU after fc2
         x = self.fc3(x)  # Output layer
         return x
     
@@ -73,10 +78,8 @@ class ResNet9(nn.Module):
         # self.avgpool = nn.AdaptiveAvgPool2d((1, 1))  # Changed to adaptive average pooling:         self.MaxPool2d = nn.Sequential(nn.MaxPool2d(4))
         self.pool = nn.MaxPool2d(kernel_size=2, stride=2)
 
-        # Calculate the size of the features after the convolutional layers
-        dummy_input = torch.zeros(1, in_channels, *input_size)
-        dummy_output = self.pool(self.layer3_head(self.layer2(self.layer1_head(self.prep(dummy_input)))))
-        self.feature_size = dummy_output.size(1) * dummy_output.size(2) * dummy_output.size(3)
+        # Calculate the size of the features after the convolutional layers (three pooled blocks + final pool)
+        self.feature_size = 512 * (input_size[0] // 16) * (input_size[1] // 16)
 
         # Output layer
         self.linear = nn.Linear(self.feature_size, num_classes)
@@ -84,14 +87,38 @@ class ResNet9(nn.Module):
     def forward(self, x):
         x = self.prep(x)
         x = self.layer1_head(x)
-        x = self.layer1_residual(x) + x
+        # in-place residual adds skip an allocation at inference; with grad enabled the ReLU output
+        # they would overwrite is saved for backward, so training keeps the out-of-place add
+        out = self.layer1_residual(x)
+        x = out + x if torch.is_grad_enabled() else out.add_(x)
         x = self.layer2(x)
         x = self.layer3_head(x)
-        x = self.layer3_residual(x) + x
+        out = self.layer3_residual(x)
+        x = out + x if torch.is_grad_enabled() else out.add_(x)
         x = self.pool(x)  # Changed to adaptive average pooling
-        x = x.view(x.size(0), -1)
+        x = x.reshape(x.size(0), -1)
         x = self.linear(x)
         return x
+
+    def fuse_for_inference(self):
+        # Fold each BatchNorm2d into the preceding Conv2d and replace it with an Identity (eval only)
+        self.eval()
+        blocks = [self.prep, self.layer1_head, self.layer1_residual, self.layer2, self.layer3_head, self.layer3_residual]
+        with torch.no_grad():
+            for block in blocks:
+                for seq in block.modules():
+                    if not isinstance(seq, nn.Sequential):
+                        continue
+                    for i in range(len(seq) - 1):
+                        conv, bn = seq[i], seq[i + 1]
+                        if not (isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d)):
+                            continue
+                        scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+                        bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+                        conv.weight.mul_(scale.reshape(-1, 1, 1, 1))
+                        conv.bias = nn.Parameter((bias - bn.running_mean) * scale + bn.bias)
+                        seq[i + 1] = nn.Identity()
+        return self
     
 
 # dictionary with the models
@@ -105,38 +132,329 @@ models = {
 # Helper functions 
 #############################################################################################################
 
+# Prefetch the next batch to the GPU on a side stream while the current batch is processed
+class CudaPrefetcher:
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _preload(self, loader_iter):
+        try:
+            data, target = next(loader_iter)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream):
+            data = data.to(self.device, memory_format=torch.channels_last, non_blocking=True)
+            target = target.to(self.device, non_blocking=True)
+        return data, target
+
+    def __iter__(self):
+        loader_iter = iter(self.loader)
+        next_batch = self._preload(loader_iter)
+        while next_batch is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+            data, target = next_batch
+            data.record_stream(torch.cuda.current_stream())
+            target.record_stream(torch.cuda.current_stream())
+            next_batch = self._preload(loader_iter)
+            yield data, target
+
+
+# slice batches directly from a dataset kept on the device (no workers, no per-sample __getitem__)
+def tensor_batches(dataset, device, batch_size, shuffle=False, drop_last=False):
+    features, labels = dataset.to_device(device)
+    n = len(features)
+    end = n - n % batch_size if drop_last else n
+    perm = torch.randperm(n, device=features.device) if shuffle else None
+    for i in range(0, end, batch_size):
+        if perm is None:
+            data, target = features[i:i + batch_size], labels[i:i + batch_size]
+        else:
+            idx = perm[i:i + batch_size]
+            data, target = features[idx], labels[idx]
+        yield data.contiguous(memory_format=torch.channels_last), target
+
+
+# iterate over the batches of a loader already moved to the device
+def device_batches(loader, device):
+    dataset = loader.dataset
+    # only plain sequential/random samplers, a DistributedSampler shards the data and needs the DataLoader
+    if isinstance(dataset, CombinedDataset) and dataset.in_memory() and isinstance(loader.sampler, (RandomSampler, SequentialSampler)):
+        return tensor_batches(dataset, device, loader.batch_size,
+                              shuffle=isinstance(loader.sampler, RandomSampler), drop_last=loader.drop_last)
+    if torch.device(device).type == 'cuda':
+        return CudaPrefetcher(loader, device)
+    return ((data.to(device, memory_format=torch.channels_last, non_blocking=True), target.to(device, non_blocking=True))
+            for data, target in loader)
+
+
+# Whole training step (forward, backward, optimizer step) captured once in a CUDA graph and replayed per batch
+# Meant for launch-bound models such as LeNet5; runs in fp32 because GradScaler's inf check (skip step on overflow)
+# cannot be captured in a graph
+class CudaGraphStep:
+    def __init__(self, model, optimizer, warmup_iters=3):
+        self.model = model
+        self.optimizer = optimizer
+        self.warmup_iters = warmup_iters
+        self.graph = None
+
+    # batches with a different shape (e.g. a ragged last batch) go through the eager step
+    def accepts(self, data):
+        return self.graph is None or data.shape == self.static_x.shape
+
+    def _capture(self, data, target):
+        self.static_x = data.clone()
+        self.static_y = target.clone()
+        # snapshot the model and optimizer so the warm-up steps leave no trace on training
+        model_state = copy.deepcopy(self.model.state_dict())
+        optimizer_state = {p: {k: v.clone() for k, v in state.items() if torch.is_tensor(v)}
+                           for p, state in self.optimizer.state.items()}
+        # warm up on a side stream (on the cloned batch) so the optimizer state exists before capture
+        side_stream = torch.cuda.Stream()
+        side_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(side_stream):
+            for _ in range(self.warmup_iters):
+                self.optimizer.zero_grad(set_to_none=True)
+                F.cross_entropy(self.model(self.static_x), self.static_y).backward()
+                self.optimizer.step()
+        torch.cuda.current_stream().wait_stream(side_stream)
+        # restore in place so the captured graph sees the same tensors; buffers created by the warm-up are
+        # zeroed, which for SGD momentum gives the same first step as a fresh buffer (buffer = grad)
+        with torch.no_grad():
+            self.model.load_state_dict(model_state)
+            for p, state in self.optimizer.state.items():
+                saved = optimizer_state.get(p, {})
+                for k, v in state.items():
+                    if not torch.is_tensor(v):
+                        continue
+                    if k in saved:
+                        v.copy_(saved[k])
+                    else:
+                        v.zero_()
+        # grads are allocated from the graph's private pool and stay static across replays
+        self.optimizer.zero_grad(set_to_none=True)
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph):
+            self.static_loss = F.cross_entropy(self.model(self.static_x), self.static_y)
+            self.static_loss.backward()
+            self.optimizer.step()
+
+    def __call__(self, data, target):
+        if self.graph is None:
+            self._capture(data, target)
+        self.static_x.copy_(data, non_blocking=True)
+        self.static_y.copy_(target, non_blocking=True)
+        self.graph.replay()
+        return self.static_loss
+
+
+# SGD with momentum applied to all parameters at once with multi-tensor (foreach) kernels
+def sgd_step(params, lr, momentum, buffers):
+    grads = [p.grad for p in params]
+    torch._foreach_mul_(buffers, momentum)
+    torch._foreach_add_(buffers, grads)
+    torch._foreach_add_(params, buffers, alpha=-lr)
+
+
+# Optimizer built on sgd_step, a base for custom (e.g. FL-specific) update rules
+# Zero-initialized buffers give the same first step as torch SGD (buffer = grad) without a branch
+class ForeachSGD(torch.optim.Optimizer):
+    def __init__(self, params, lr, momentum=0.0):
+        super().__init__(params, dict(lr=lr, momentum=momentum))
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+        for group in self.param_groups:
+            params = [p for p in group['params'] if p.grad is not None]
+            buffers = []
+            for p in params:
+                state = self.state[p]
+                if 'momentum_buffer' not in state:
+                    state['momentum_buffer'] = torch.zeros_like(p, memory_format=torch.preserve_format)
+                buffers.append(state['momentum_buffer'])
+            if params:
+                sgd_step(params, group['lr'], group['momentum'], buffers)
+        return loss
+
+
+# strip torch.compile and DistributedDataParallel wrappers
+def unwrap_model(model):
+    model = getattr(model, '_orig_mod', model)
+    if isinstance(model, nn.parallel.DistributedDataParallel):
+        model = model.module
+    return model
+
+
+# Export a model to ONNX (static shapes) and build an FP16 TensorRT engine for inference (needs tensorrt)
+def export_trt(model, sample_input, path):
+    import tensorrt as trt
+    onnx_path = os.path.splitext(path)[0] + '.onnx'
+    # export a (fused) copy so the caller's model keeps its mode and BatchNorm layers
+    model = copy.deepcopy(unwrap_model(model)).eval()
+    if hasattr(model, 'fuse_for_inference'):
+        model = model.fuse_for_inference()
+    torch.onnx.export(model, sample_input.contiguous(), onnx_path, opset_version=17, dynamic_axes=None,
+                      input_names=['input'], output_names=['output'])
+
+    logger = trt.Logger(trt.Logger.WARNING)
+    builder = trt.Builder(logger)
+    network = builder.create_network(1 << int(trt.NetworkDefinitionCreationFlag.EXPLICIT_BATCH))
+    parser = trt.OnnxParser(network, logger)
+    if not parser.parse_from_file(onnx_path):
+        raise RuntimeError(f"Failed to parse {onnx_path}: {parser.get_error(0)}")
+    config = builder.create_builder_config()
+    config.set_flag(trt.BuilderFlag.FP16)
+    serialized_engine = builder.build_serialized_network(network, config)
+    if serialized_engine is None:
+        raise RuntimeError(f"Failed to build a TensorRT engine from {onnx_path}")
+    with open(path, 'wb') as f:
+        f.write(serialized_engine)
+    return TRTModel(serialized_engine)
+
+
+# Run a serialized TensorRT engine on CUDA tensors (fixed input shape)
+class TRTModel:
+    def __init__(self, serialized_engine):
+        import tensorrt as trt
+        self.runtime = trt.Runtime(trt.Logger(trt.Logger.WARNING))
+        self.engine = self.runtime.deserialize_cuda_engine(serialized_engine)
+        self.context = self.engine.create_execution_context()
+        self.input_shape = tuple(self.engine.get_tensor_shape('input'))
+        self.output = torch.empty(tuple(self.engine.get_tensor_shape('output')), device='cuda')
+
+    def __call__(self, x):
+        x = x.contiguous().float()  # the engine expects a dense NCHW fp32 input
+        self.context.set_tensor_address('input', x.data_ptr())
+        self.context.set_tensor_address('output', self.output.data_ptr())
+        self.context.execute_async_v3(torch.cuda.current_stream().cuda_stream)
+        return self.output.clone()
+
+
+# Post-training static int8 quantization for CPU inference, calibrated on a few batches of calib_loader
+# FX graph mode handles conv+bn+relu fusion, quant/dequant stubs and the residual adds without model surgery
+def quantize_int8(model, calib_loader, num_batches=10):
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+    model = copy.deepcopy(unwrap_model(model)).cpu().eval()
+    example_inputs = (next(iter(calib_loader))[0].float(),)
+    prepared = prepare_fx(model, get_default_qconfig_mapping('fbgemm'), example_inputs)
+    with torch.no_grad():
+        for batch_idx, (data, _) in enumerate(calib_loader):
+            if batch_idx >= num_batches:
+                break
+            prepared(data.float())
+    return convert_fx(prepared)
+
+
+# Fused, scripted and frozen copy of a model for repeated evaluation, cached per model and rebuilt only
+# when its weights change (in-place updates bump the tensors' _version, new tensors change data_ptr)
+_inference_cache = weakref.WeakKeyDictionary()
+
+def inference_model(model):
+    base = unwrap_model(model)
+    if not hasattr(base, 'fuse_for_inference'):
+        return model
+    key = tuple((t.data_ptr(), t._version) for t in itertools.chain(base.parameters(), base.buffers()))
+    cached = _inference_cache.get(base)
+    if cached is None or cached[0] != key:
+        # fuse a copy so the original model keeps its state_dict keys (shared with the server)
+        fused = copy.deepcopy(base).fuse_for_inference()
+        # script and freeze the fused copy (parameters inlined as constants for folding and fusion)
+        cached = (key, torch.jit.freeze(torch.jit.script(fused)))
+        _inference_cache[base] = cached
+    return cached[1]
+
+
+# mixed precision context: fp16 on CUDA, a no-op elsewhere
+# (CPU stays in fp32: bf16 is slower there without native support; MPS stays in fp32: older PyTorch
+# rejects torch.autocast('mps') even when disabled)
+def autocast_context(device, enabled=True):
+    if not enabled or torch.device(device).type != 'cuda':
+        return contextlib.nullcontext()
+    return torch.autocast(device_type='cuda', dtype=torch.float16)
+
+
 # simple train function
-def simple_train(model, device, train_loader, optimizer, epoch, client_id=None):
+def simple_train(model, device, train_loader, optimizer, epoch, client_id=None, scaler=None, graph_step=None):
     model.train()
-    loss_list = []
-    for batch_idx, (data, target) in enumerate(train_loader):
-        data, target = data.to(device), target.to(device)
-        optimizer.zero_grad()
-        output = model(data)
-        loss = F.cross_entropy(output, target)
-        loss.backward()
-        optimizer.step()
+    # mixed precision with loss scaling only when the caller passes an enabled scaler, which must outlive
+    # this call so the learned loss scale carries over between epochs and rounds
+    use_amp = scaler is not None and scaler.is_enabled()
+    # keep the running loss on the device, synchronize once per epoch
+    loss_sum = torch.zeros((), device=device)
+    n_batches = 0
+    for batch_idx, (data, target) in enumerate(device_batches(train_loader, device)):
+        if graph_step is not None and graph_step.accepts(data):
+            loss = graph_step(data, target)
+        else:
+            optimizer.zero_grad(set_to_none=True)
+            with autocast_context(device, enabled=use_amp):
+                output = model(data)
+                loss = F.cross_entropy(output, target)
+            if use_amp:
+                scaler.scale(loss).backward()
+                scaler.step(optimizer)
+                scaler.update()
+            else:
+                loss.backward()
+                optimizer.step()
         # if batch_idx % 10 == 0:
         #     print(f'Train Epoch: {epoch} [{batch_idx * len(data)}/{len(train_loader.dataset)} '
         #           f'({100. * batch_idx / len(train_loader):.0f}%)]\tLoss: {loss.item():.6f}')
-        loss_list.append(loss.item())
-    # print(f'Client: {client_id} - Train Epoch: {epoch} \tLoss: {sum(loss_list)/len(loss_list):.6f}')
+        loss_sum += loss.detach()
+        n_batches += 1
+    epoch_loss = loss_sum.item() / max(n_batches, 1)
+    # print(f'Client: {client_id} - Train Epoch: {epoch} \tLoss: {epoch_loss:.6f}')
+    return epoch_loss
 
 
 # simple test function
-def simple_test(model, device, test_loader):
+def simple_test(model, device, test_loader, trt_model=None, chunk_size=4096, int8=False, fuse=False):
     model.eval()
-    test_loss = 0
-    correct = 0
-    with torch.no_grad():
-        for data, target in test_loader:
-            data, target = data.to(device), target.to(device)
-            output = model(data)
-            test_loss += F.cross_entropy(output, target, reduction='sum').item()  # sum up batch loss
-            pred = output.argmax(dim=1, keepdim=True)  # get the index of the max log-probability
-            correct += pred.eq(target.view_as(pred)).sum().item()
-
-    test_loss /= len(test_loader.dataset)
+    # autocast only on CUDA, so CPU/MPS metrics are computed in fp32
+    on_cuda = torch.device(device).type == 'cuda'
+    if int8 and torch.device(device).type == 'cpu':
+        # quantized copy with int8 kernels
+        model = quantize_int8(model, test_loader)
+    # opt-in: fusing and scripting only pays off when the same weights are evaluated many times;
+    # skipped with a TensorRT engine, which runs every full chunk (only a ragged tail uses the model)
+    elif fuse and trt_model is None:
+        model = inference_model(model)
+    # in-memory test sets are staged on the device once; on CUDA they are evaluated in large chunks,
+    # elsewhere in the loader's batch size, and a TensorRT engine dictates its own static batch size
+    dataset = test_loader.dataset
+    if isinstance(dataset, CombinedDataset) and dataset.in_memory():
+        if trt_model is not None:
+            chunk_size = trt_model.input_shape[0]
+        elif not on_cuda:
+            chunk_size = test_loader.batch_size
+        batches = tensor_batches(dataset, device, chunk_size)
+    else:
+        batches = device_batches(test_loader, device)
+    # accumulate on the device and synchronize once at the end
+    test_loss = torch.zeros((), device=device)
+    correct = torch.zeros((), device=device)
+    with torch.no_grad(), autocast_context(device, enabled=on_cuda):
+        for data, target in batches:
+            # TensorRT engine for batches matching its static shape, PyTorch model otherwise
+            if trt_model is not None and tuple(data.shape) == trt_model.input_shape:
+                output = trt_model(data)
+            else:
+                output = model(data)
+            logp = F.log_softmax(output, dim=1)
+            test_loss += F.nll_loss(logp, target, reduction='sum')  # sum up batch loss
+            correct += (logp.argmax(dim=1) == target).sum()  # get the index of the max log-probability
+
+    test_loss = test_loss.item() / len(test_loader.dataset)
+    correct = correct.item()
     accuracy = correct / len(test_loader.dataset)
     # print(f'\nTest set: Average loss: {test_loss:.4f}, Accuracy: {correct}/{len(test_loader.dataset)} '
     #       f'({100. * correct / len(test_loader.dataset):.0f}%)\n')
@@ -146,9 +464,14 @@ def simple_test(model, device, test_loader):
 # Dataset class
 class CombinedDataset(Dataset):
     def __init__(self, features, labels, transform=None):
-        self.features = features
-        self.labels = labels
+        # contiguous tensors, pinned when a GPU is present so host-to-device copies are async
+        self.features = torch.as_tensor(features).contiguous()
+        self.labels = torch.as_tensor(labels).contiguous()
+        if torch.cuda.is_available():
+            self.features = self.features.pin_memory()
+            self.labels = self.labels.pin_memory()
         self.transform = transform
+        self._device_data = None
 
     def __len__(self):
         return len(self.features)
@@ -162,6 +485,17 @@ class CombinedDataset(Dataset):
 
         return x, y
 
+    # whole dataset is a tensor that needs no per-sample processing
+    def in_memory(self):
+        return self.transform is None and isinstance(self.features, torch.Tensor)
+
+    # move features and labels to the device once and reuse them across epochs
+    def to_device(self, device):
+        device = torch.device(device)
+        if self._device_data is None or self._device_data[0] != device:
+            self._device_data = (device, self.features.to(device, non_blocking=True), self.labels.to(device, non_blocking=True))
+        return self._device_data[1], self._device_data[2]
+
 
 
 
@@ -174,7 +508,10 @@ def main():
     from non_iiddata_generator_no_drifting import merge_data
     import torch
     import torch.optim as optim
+    import torch.distributed as dist
+    from torch.nn.parallel import DistributedDataParallel
     from torch.utils.data import DataLoader
+    from torch.utils.data.distributed import DistributedSampler
 
     # Training settings
     model_name = "ResNet9"   # Options: "LeNet5", "ResNet9"
@@ -200,6 +537,13 @@ def main():
 
     print(f"\n\033[94mTraining {model_name} on {dataset_name} with {client_number} clients\033[0m\n")
 
+    # multi-GPU data parallel training when launched with torchrun (one process per GPU)
+    distributed = int(os.environ.get("WORLD_SIZE", 1)) > 1
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+    if distributed:
+        torch.cuda.set_device(local_rank)
+        dist.init_process_group('nccl')
+
     device = utils.check_gpu(manual_seed=True, print_info=True)
     torch.manual_seed(seed)
 
@@ -232,17 +576,37 @@ def main():
     test_dataset = CombinedDataset(test_features, test_labels, transform=transform)
 
     # Create the data loaders
-    train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True)
-    test_loader = DataLoader(test_dataset, batch_size=test_batch_size, shuffle=False)
+    loader_kwargs = dict(num_workers=4, pin_memory=(device == 'cuda'), persistent_workers=True, prefetch_factor=4)
+    train_sampler = DistributedSampler(train_dataset, shuffle=True, drop_last=True) if distributed else None
+    train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=(train_sampler is None), sampler=train_sampler, drop_last=True, **loader_kwargs)  # fixed batch shape for compiled graphs
+    test_loader = DataLoader(test_dataset, batch_size=test_batch_size, shuffle=False, **loader_kwargs)
 
     # model = LeNet5(in_channels=3, num_classes=10, input_size=(32,32)).to(device)
     model = models[model_name](in_channels=3, num_classes=10, input_size=(32,32)).to(device)
-    optimizer = optim.SGD(model.parameters(), lr=lr, momentum=momentum)
+    model = model.to(memory_format=torch.channels_last)  # NHWC layout for faster cuDNN conv kernels
+    # LeNet5 is launch-bound: replay the whole training step as a CUDA graph instead of compiling it
+    use_graph_step = device == 'cuda' and model_name == 'LeNet5' and not distributed
+    if distributed:
+        model = DistributedDataParallel(model, device_ids=[local_rank], bucket_cap_mb=25)  # all-reduce overlapped with backward
+    if device == 'cuda' and not use_graph_step:
+        # CUDA graphs + fused kernels; dynamo guards on model.training, so the eval pass in simple_test
+        # (which runs the model as passed in unless fuse=True) gets its own graph from this same compile call
+        model = torch.compile(model, mode="reduce-overhead")
+    # single multi-tensor update kernel (fused and foreach cannot be set together)
+    fused = device == 'cuda'
+    optimizer = optim.SGD(model.parameters(), lr=lr, momentum=momentum, fused=fused, foreach=not fused)
+    scaler = torch.amp.GradScaler('cuda', enabled=device == 'cuda')
+    graph_step = CudaGraphStep(model, optimizer) if use_graph_step else None
 
 
     for epoch in range(1, epochs + 1):
-        simple_train(model, device, train_loader, optimizer, epoch)
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)
+        simple_train(model, device, train_loader, optimizer, epoch, scaler=scaler, graph_step=graph_step)
         _, _ = simple_test(model, device, test_loader)
 
+    if distributed:
+        dist.destroy_process_group()
+
 if __name__ == '__main__':
     main()
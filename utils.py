@@ -64,6 +64,10 @@ def check_gpu(manual_seed=True, print_info=True):
             print("CUDA is available")
         device = 'cuda'
         torch.cuda.manual_seed_all(0) 
+        # autotune conv algorithms for the fixed input shapes and allow TF32 math on Ampere+
+        torch.backends.cudnn.benchmark = True
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
     elif torch.backends.mps.is_available():
         if print_info:
             print("MPS is available")